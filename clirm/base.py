@@ -1,11 +1,22 @@
 from __future__ import annotations
 
+import array
+import collections
+import contextlib
+import copy
 import dataclasses
 import enum
+import functools
+import itertools
+import json
+import operator
+import pathlib
+import queue
 import sqlite3
 import sys
+import threading
 import weakref
-from collections.abc import Iterator, Mapping, Sequence
+from collections.abc import Callable, Iterable, Iterator, Mapping, Sequence
 from types import NoneType, UnionType
 from typing import (
     Any,
@@ -36,6 +47,30 @@ class UnresolvedType(Exception):
     """Raised when a field's type has not yet been resolved."""
 
 
+def identity(value: T) -> T:
+    return value
+
+
+# Placeholder for column values that have not been loaded from the database
+UNLOADED: Any = object()
+# Number of rows fetched at a time by Query.iterator()
+ITERATOR_BATCH_SIZE = 1024
+# Types that round-trip through SQLite's json_each() unchanged
+JSON_SCALAR_TYPES = (int, str, bool, NoneType)
+# Parameter limit assumed when the connection is not known; SQLite builds
+# before 3.32 allow at most 999 parameters per statement
+DEFAULT_PARAMETER_LIMIT = 999
+# (name, value, SQLite's default value); a setting is only changed if the
+# connection still has the default
+CONNECTION_PRAGMAS = (
+    ("temp_store", "MEMORY", 0),
+    ("cache_size", "-20000", -2000),
+    # Read file databases through memory mapping (256 MB); no effect in memory
+    ("mmap_size", "268435456", 0),
+)
+FILE_CONNECTION_PRAGMAS = ("journal_mode = WAL", "synchronous = NORMAL")
+
+
 @dataclasses.dataclass
 class Clirm:
     conn: sqlite3.Connection
@@ -43,9 +78,125 @@ class Clirm:
     models_with_unresolved_types: set[type[Model]] = dataclasses.field(
         default_factory=set
     )
+    # If True, apply CONNECTION_PRAGMAS (and for file databases,
+    # FILE_CONNECTION_PRAGMAS) to the connection.
+    configure_connection: bool = True
+    # Number of additional read-only connections used for queries outside of
+    # transactions. Only supported for file databases.
+    reader_pool_size: int = 0
+    journal_mode: str = dataclasses.field(init=False)
+    _readers: queue.SimpleQueue[sqlite3.Connection] | None = dataclasses.field(
+        default=None, init=False, repr=False
+    )
+    _name_to_model_cls: dict[str, type[Model]] | None = dataclasses.field(
+        default=None, init=False, repr=False
+    )
+    # (module name, forward reference) -> resolved object
+    _forward_ref_cache: dict[tuple[str, str], Any] = dataclasses.field(
+        default_factory=dict, init=False, repr=False
+    )
+    # Thread running an open transaction() block, if any
+    _transaction_thread: int | None = dataclasses.field(
+        default=None, init=False, repr=False
+    )
+    # Objects deleted in the open transaction() block, restored on rollback
+    _deleted_objects: list[Model] = dataclasses.field(
+        default_factory=list, init=False, repr=False
+    )
+    # Thread that created the Clirm, which is assumed to own conn
+    _conn_thread: int = dataclasses.field(init=False, repr=False)
+    # Per-thread state: the reader connection the thread has borrowed and the
+    # number of open borrows using it
+    _local: threading.local = dataclasses.field(
+        default_factory=threading.local, init=False, repr=False
+    )
+
+    def __post_init__(self) -> None:
+        self._conn_thread = threading.get_ident()
+        # Empty for in-memory databases
+        _, _, path = self.conn.execute("PRAGMA database_list").fetchone()
+        if self.configure_connection:
+            apply_connection_pragmas(self.conn)
+            # In-memory databases do not support WAL and never sync to disk
+            if path and not self.conn.in_transaction:
+                for pragma in FILE_CONNECTION_PRAGMAS:
+                    try:
+                        self.conn.execute(f"PRAGMA {pragma}")
+                    except sqlite3.OperationalError:
+                        # Read-only connections cannot change the journal mode
+                        pass
+        (self.journal_mode,) = self.conn.execute("PRAGMA journal_mode").fetchone()
+        if self.reader_pool_size > 0:
+            # Without WAL, an open reader would block commits on the main
+            # connection.
+            if not path or self.journal_mode != "wal":
+                raise ValueError("Reader connections require a database in WAL mode")
+            self._readers = queue.SimpleQueue()
+            uri = f"{pathlib.Path(path).as_uri()}?mode=ro"
+            for _ in range(self.reader_pool_size):
+                reader = sqlite3.connect(uri, uri=True, check_same_thread=False)
+                if self.configure_connection:
+                    apply_connection_pragmas(reader)
+                self._readers.put(reader)
+
+    @contextlib.contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a connection for running queries.
+
+        Without a reader pool, this is the main connection. On the thread that
+        owns the main connection, the main connection is also used inside a
+        transaction, so that uncommitted changes are visible, and for queries
+        nested in another query, so that they see changes made in between.
+        Other threads reuse the reader they already hold for nested queries,
+        and otherwise wait until a reader is available.
+
+        """
+        readers = self._readers
+        thread = threading.get_ident()
+        if readers is None or self._transaction_thread == thread:
+            yield self.conn
+            return
+        borrowed = getattr(self._local, "reader", None)
+        if thread == self._conn_thread and (
+            borrowed is not None or self.conn.in_transaction
+        ):
+            yield self.conn
+            return
+        if borrowed is None:
+            borrowed = self._local.reader = readers.get()
+            self._local.depth = 0
+        self._local.depth += 1
+        try:
+            yield borrowed
+        finally:
+            # Generators may finish in any order, so the reader goes back only
+            # when the last borrow using it ends
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                self._local.reader = None
+                if self._readers is readers:
+                    readers.put(borrowed)
+                else:
+                    borrowed.close()
+
+    def close_readers(self) -> None:
+        """Close the reader connections. The main connection stays open."""
+        readers, self._readers = self._readers, None
+        if readers is None:
+            return
+        # Readers that are in use are closed when they are returned
+        while True:
+            try:
+                readers.get_nowait().close()
+            except queue.Empty:
+                break
 
     def get_name_to_model_cls(self) -> dict[str, type[Model]]:
-        return {cls.__name__: cls for cls in self.models.values()}
+        if self._name_to_model_cls is None:
+            self._name_to_model_cls = {
+                cls.__name__: cls for cls in self.models.values()
+            }
+        return self._name_to_model_cls
 
     def try_resolve_all_types(self) -> None:
         self.models_with_unresolved_types = {
@@ -57,33 +208,88 @@ class Clirm:
     def select_one(
         self, query: str, parameters: tuple[Any, ...] = ()
     ) -> Mapping[str, Any] | None:
-        with self.conn:
-            cursor = self.conn.cursor()
+        with self.reader() as conn:
+            cursor = conn.cursor()
             cursor.row_factory = sqlite3.Row
-            res = cursor.execute(query, parameters)
-            return res.fetchone()
+            return cursor.execute(query, parameters).fetchone()
 
     def select(self, query: str, parameters: tuple[Any, ...] = ()) -> sqlite3.Cursor:
-        with self.conn:
-            cursor = self.conn.cursor()
-            cursor.row_factory = sqlite3.Row
-            return cursor.execute(query, parameters)
+        cursor = self.conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        return cursor.execute(query, parameters)
 
     def select_tuple(self, query: str, parameters: tuple[Any, ...] = ()) -> Any:
-        with self.conn:
-            cursor = self.conn.cursor()
-            res = cursor.execute(query, parameters)
-            return res.fetchone()
+        with self.reader() as conn:
+            # Plain tuples are cheaper to create than sqlite3.Row
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            return cursor.execute(query, parameters).fetchone()
 
     def execute(self, query: str, parameters: tuple[Any, ...] = ()) -> sqlite3.Cursor:
+        if self._transaction_thread is not None:
+            return self.conn.execute(query, parameters)
+        # The connection context manager commits on success
+        with self.conn:
+            return self.conn.execute(query, parameters)
+
+    def execute_many(
+        self, query: str, parameters: Iterable[tuple[Any, ...]]
+    ) -> sqlite3.Cursor:
+        if self._transaction_thread is not None:
+            return self.conn.executemany(query, parameters)
         with self.conn:
-            cursor = self.conn.cursor()
-            res = cursor.execute(query, parameters)
+            return self.conn.executemany(query, parameters)
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Group writes into a single transaction.
+
+        Within the block, changes are not committed after every statement.
+        They are committed when the block exits, or rolled back if it raises.
+        Nested calls join the outermost transaction.
+
+        """
+        if self._transaction_thread is not None:
+            yield
+            return
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+        self._transaction_thread = threading.get_ident()
+        try:
+            yield
+            # Inside the try, so that a failed commit (e.g., because of a
+            # deferred constraint) is also rolled back.
             self.conn.commit()
-            return res
+        except BaseException:
+            self.conn.rollback()
+            # The rows exist again, so their objects must be found by id
+            for obj in self._deleted_objects:
+                type(obj)._clirm_add_to_cache(obj._clirm_data[0], obj)
+            self._discard_loaded_data()
+            raise
+        finally:
+            self._transaction_thread = None
+            self._deleted_objects.clear()
+
+    def _discard_loaded_data(self) -> None:
+        # Cached objects may hold values that were rolled back
+        for model in self.models.values():
+            for obj in list(model._clirm_instance_cache.values()):
+                obj._clirm_data = model._clirm_empty_data(obj._clirm_data[0])
+                obj._clirm_dirty_fields.clear()
+
+
+def apply_connection_pragmas(conn: sqlite3.Connection) -> None:
+    for name, value, default in CONNECTION_PRAGMAS:
+        # mmap_size returns no row for in-memory databases
+        row = conn.execute(f"PRAGMA {name}").fetchone()
+        if row is None or row[0] == default:
+            conn.execute(f"PRAGMA {name} = {value}")
 
 
 class Condition:
+    __slots__ = ()
+
     def __or__(self, other: Condition) -> OrCondition:
         return OrCondition(self, other)
 
@@ -91,67 +297,119 @@ class Condition:
         return NotCondition(self)
 
     def stringify(self) -> tuple[str, tuple[object, ...]]:
-        raise NotImplementedError
+        sql_parts: list[str] = []
+        params: list[object] = []
+        self.emit(sql_parts, params)
+        return "".join(sql_parts), tuple(params)
 
+    def emit(self, sql_parts: list[str], params: list[object]) -> None:
+        """Append the SQL for this condition and its parameters to the lists.
 
-@dataclasses.dataclass
+        Subclasses must override either this method or stringify().
+
+        """
+        if type(self).stringify is Condition.stringify:
+            raise NotImplementedError(
+                f"{type(self).__name__} must override emit() or stringify()"
+            )
+        sql, args = self.stringify()
+        sql_parts.append(sql)
+        params.extend(args)
+
+
+@dataclasses.dataclass(slots=True)
 class Comparison(Condition):
     left: Field[Any]
     operator: Literal["<", "<=", ">", ">=", "=", "!=", "INSTR", "LIKE"]
     right: Any
+    # SQL and parameters are computed once, when the condition is created
+    _sql: str = dataclasses.field(init=False, repr=False, compare=False)
+    _params: tuple[object, ...] = dataclasses.field(
+        init=False, repr=False, compare=False
+    )
 
-    def stringify(self) -> tuple[str, tuple[object, ...]]:
+    def __post_init__(self) -> None:
         if self.right is None:
             match self.operator:
                 case "=":
-                    return f"(`{self.left.name}` IS NULL)", ()
+                    self._sql = f"({self.left._quoted_name} IS NULL)"
                 case "!=":
-                    return f"(`{self.left.name}` IS NOT NULL)", ()
+                    self._sql = f"({self.left._quoted_name} IS NOT NULL)"
                 case _:
                     raise TypeError("Unsupported operator")
-        right = self.left.serialize(self.right)
+            self._params = ()
+            return
+        self._params = (self.left.serialize(self.right),)
         match self.operator:
             case "INSTR":
-                return f"INSTR(`{self.left.name}`, ?)", (right,)
+                self._sql = f"INSTR({self.left._quoted_name}, ?)"
             case _:
-                return f"(`{self.left.name}` {self.operator} ?)", (right,)
-        assert False, "unreachable"
+                self._sql = f"({self.left._quoted_name} {self.operator} ?)"
 
+    def stringify(self) -> tuple[str, tuple[object, ...]]:
+        return self._sql, self._params
 
-@dataclasses.dataclass
+    def emit(self, sql_parts: list[str], params: list[object]) -> None:
+        sql_parts.append(self._sql)
+        params.extend(self._params)
+
+
+@dataclasses.dataclass(slots=True)
 class OrCondition(Condition):
     left: Condition
     right: Condition
 
-    def stringify(self) -> tuple[str, tuple[object, ...]]:
-        left, left_args = self.left.stringify()
-        right, right_args = self.right.stringify()
-        return f"({left} OR {right})", (*left_args, *right_args)
+    def emit(self, sql_parts: list[str], params: list[object]) -> None:
+        sql_parts.append("(")
+        self.left.emit(sql_parts, params)
+        sql_parts.append(" OR ")
+        self.right.emit(sql_parts, params)
+        sql_parts.append(")")
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class NotCondition(Condition):
     cond: Condition
 
-    def stringify(self) -> tuple[str, tuple[object, ...]]:
-        query, args = self.cond.stringify()
-        return f"NOT {query}", args
+    def emit(self, sql_parts: list[str], params: list[object]) -> None:
+        sql_parts.append("NOT ")
+        self.cond.emit(sql_parts, params)
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Contains(Condition):
     left: Field
     positive: bool
     values: Sequence[Any]
 
-    def stringify(self) -> tuple[str, tuple[object, ...]]:
-        vals = tuple(self.left.serialize(val) for val in self.values)
-        placeholders = ", ".join("?" for _ in vals)
+    def emit(self, sql_parts: list[str], params: list[object]) -> None:
+        vals = [self.left.serialize(val) for val in self.values]
         condition = "IN" if self.positive else "NOT IN"
-        return f"(`{self.left.name}` {condition} ({placeholders}))", vals
+        # Leave room for a LIMIT parameter
+        if len(params) + len(vals) >= self._parameter_limit() and all(
+            type(val) in JSON_SCALAR_TYPES for val in vals
+        ):
+            # Too many values for one parameter each, so pass them as a single
+            # JSON array. Unlike a list of parameters, the values from
+            # json_each() do not get the column's type affinity.
+            sql_parts.append(
+                f"({self.left._quoted_name} {condition} (SELECT value FROM json_each(?)))"
+            )
+            params.append(json.dumps(vals))
+        else:
+            placeholders = ", ".join("?" for _ in vals)
+            sql_parts.append(f"({self.left._quoted_name} {condition} ({placeholders}))")
+            params.extend(vals)
 
+    def _parameter_limit(self) -> int:
+        model_cls = getattr(self.left, "model_cls", None)
+        if model_cls is None:
+            # e.g. the id field, which is shared by all models
+            return DEFAULT_PARAMETER_LIMIT
+        return model_cls.clirm.conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
 
-@dataclasses.dataclass
+
+@dataclasses.dataclass(slots=True)
 class Func:
     name: str
 
@@ -159,20 +417,24 @@ class Func:
         return f"{self.name}()", ()
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class OrderBy:
     field: Field[Any]
     ascending: bool
 
     def stringify(self) -> tuple[str, tuple[object, ...]]:
         direction = "ASC" if self.ascending else "DESC"
-        return f"`{self.field.name}` {direction}", ()
+        return f"{self.field._quoted_name} {direction}", ()
 
 
 ModelT = TypeVar("ModelT", bound="Model")
+# (attribute name, column name, serializer, has default, serialized default)
+CreatePlanEntry = tuple[str, str, Callable[[Any], Any], bool, Any]
+# Named tuple type and per-column deserializers used by Query.iterator()
+RowType = tuple[type[tuple[Any, ...]], list[Callable[[Any], Any]]]
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Query(Generic[ModelT]):
     model: type[ModelT]
     conditions: Sequence[Condition] = ()
@@ -183,38 +445,74 @@ class Query(Generic[ModelT]):
         kwargs_conds = [
             getattr(self.model, key) == value for key, value in kwargs.items()
         ]
-        return dataclasses.replace(
-            self, conditions=[*self.conditions, *conds, *kwargs_conds]
+        return type(self)(
+            self.model,
+            (*self.conditions, *conds, *kwargs_conds),
+            self.order_by_columns,
+            self.limit_clause,
         )
 
     def limit(self, limit: int | None) -> Query[ModelT]:
-        return dataclasses.replace(self, limit_clause=limit)
+        return type(self)(self.model, self.conditions, self.order_by_columns, limit)
 
     def order_by(self, *orders: OrderBy | Field[object] | Func) -> Query[ModelT]:
         clauses = [
             OrderBy(item, True) if isinstance(item, Field) else item for item in orders
         ]
-        return dataclasses.replace(
-            self, order_by_columns=[*self.order_by_columns, *clauses]
+        return type(self)(
+            self.model,
+            self.conditions,
+            (*self.order_by_columns, *clauses),
+            self.limit_clause,
         )
 
     def stringify(self, columns: str = "*") -> tuple[str, tuple[object, ...]]:
-        query = f"SELECT {columns} FROM {self.model.clirm_table_name}"
+        sql_parts = [f"SELECT {columns} FROM {self.model.clirm_table_name}"]
         params: list[object] = []
         if self.conditions:
-            pairs = [cond.stringify() for cond in self.conditions]
-            where = " AND ".join(cond for cond, _ in pairs)
-            query = f"{query} WHERE {where}"
-            params += (param for _, params in pairs for param in params)
+            sql_parts.append(" WHERE ")
+            for i, cond in enumerate(self.conditions):
+                if i:
+                    sql_parts.append(" AND ")
+                cond.emit(sql_parts, params)
         if self.order_by_columns:
-            pairs = [item.stringify() for item in self.order_by_columns]
-            order_by = ", ".join(item for item, _ in pairs)
-            params += (param for _, params in pairs for param in params)
-            query = f"{query} ORDER BY {order_by}"
+            sql_parts.append(" ORDER BY ")
+            for i, item in enumerate(self.order_by_columns):
+                if i:
+                    sql_parts.append(", ")
+                item_sql, item_params = item.stringify()
+                sql_parts.append(item_sql)
+                params.extend(item_params)
         if self.limit_clause is not None:
-            query += " LIMIT ?"
+            sql_parts.append(" LIMIT ?")
             params.append(self.limit_clause)
-        return query, tuple(params)
+        return "".join(sql_parts), tuple(params)
+
+    def only(self, *fields: Field[Any]) -> ValuesQuery:
+        return ValuesQuery(self, fields)
+
+    def iterator(self) -> Iterator[tuple[Any, ...]]:
+        """Yield named tuples of field values without creating model objects."""
+        model = self.model
+        query, params = self.stringify(model._clirm_select_columns)
+        row_type, deserializers = model._clirm_get_row_type()
+        with model.clirm.reader() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute(query, params)
+            while rows := cursor.fetchmany(ITERATOR_BATCH_SIZE):
+                for row in rows:
+                    yield row_type._make(map(operator.call, deserializers, row))
+
+    def ids(self) -> array.array[int]:
+        query, params = self.stringify("id")
+        with self.model.clirm.reader() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute(query, params)
+            # Build the array straight from the rows, without an intermediate
+            # list of all ids
+            return array.array("q", itertools.chain.from_iterable(cursor))
 
     def count(self) -> int:
         query, params = self.stringify("COUNT(*)")
@@ -226,25 +524,73 @@ class Query(Generic[ModelT]):
             return obj
         raise DoesNotExist(self.model)
 
+    def __contains__(self, obj: object) -> bool:
+        if not isinstance(obj, self.model):
+            return False
+        if self.limit_clause is not None:
+            # The limit applies to the ordered results, so check them directly
+            return any(row is obj for row in self)
+        query, params = self.filter(self.model.id == obj.id).stringify("1")
+        return self.model.clirm.select_tuple(f"{query} LIMIT 1", params) is not None
+
     def __iter__(self) -> Iterator[ModelT]:
+        query, params = self.stringify(self.model._clirm_select_columns)
+        with self.model.clirm.reader() as conn:
+            # Plain tuples are cheaper to create than sqlite3.Row
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            yield from map(self.model._clirm_from_row, cursor.execute(query, params))
+
+
+@dataclasses.dataclass(slots=True)
+class ValuesQuery:
+    """Query that yields tuples of field values instead of model objects."""
+
+    query: Query[Any]
+    fields: Sequence[Field[Any]]
+
+    def stringify(self) -> tuple[str, tuple[object, ...]]:
+        columns = ", ".join(field._quoted_name for field in self.fields)
+        return self.query.stringify(columns)
+
+    def __iter__(self) -> Iterator[tuple[Any, ...]]:
         query, params = self.stringify()
-        cursor = self.model.clirm.select(query, params)
-        while True:
-            rows = cursor.fetchmany()
-            if not rows:
-                break
-            for row in rows:
-                yield self.model(**row)
+        deserializers = [field.deserialize for field in self.fields]
+        with self.query.model.clirm.reader() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            for row in cursor.execute(query, params):
+                yield tuple(map(operator.call, deserializers, row))
 
 
 class Field(Generic[T]):
+    __slots__ = (
+        "name",
+        "_quoted_name",
+        "_index",
+        "default",
+        "related_name",
+        "model_cls",
+        "_type_object",
+        "_allow_none",
+        "_full_type",
+        "_serialize",
+        "_deserialize",
+        "__orig_class__",
+    )
+
     name: str
+    _quoted_name: str
+    # Position of the field's value in Model._clirm_data
+    _index: int
     default: T | None
     _type_object: type[object]
     _allow_none: bool
     _full_type: Any
+    _serialize: Callable[[T], Any]
+    _deserialize: Callable[[Any], T]
     model_cls: type[Model]
-    related_name: str | None = None
+    related_name: str | None
 
     def __init__(
         self,
@@ -254,13 +600,34 @@ class Field(Generic[T]):
         related_name: str | None = None,
     ) -> None:
         if name is not None:
-            self.name = name
+            self.name = sys.intern(name)
         self.default = default
         self.related_name = related_name
+        # Replaced with specialized functions once the type is resolved
+        self._serialize = self._lazy_serialize
+        self._deserialize = self._lazy_deserialize
+
+    def __init_subclass__(cls) -> None:
+        super().__init_subclass__()
+        # __get__ inlines get_raw() and deserialize(), so subclasses that
+        # override either of them need the generic implementation.
+        if "__get__" not in cls.__dict__ and (
+            cls.get_raw is not Field.get_raw or cls.deserialize is not Field.deserialize
+        ):
+            cls.__get__ = Field._generic_get
+
+    def _clirm_copy(self) -> Self:
+        field = copy.copy(self)
+        # Resolve the type on the copy itself if it is used first
+        if not hasattr(self, "_type_object"):
+            field._serialize = field._lazy_serialize
+            field._deserialize = field._lazy_deserialize
+        return field
 
     def __set_name__(self, owner: object, name: str) -> None:
         if not hasattr(self, "name"):
             self.name = name
+        self._quoted_name = sys.intern(f"`{self.name}`")
 
     @overload
     def __get__(self, obj: None, objtype: object = None) -> Self: ...
@@ -268,48 +635,54 @@ class Field(Generic[T]):
     def __get__(self, obj: Model | None, objtype: object = None) -> T: ...
 
     def __get__(self, obj: Model | None, objtype: object = None) -> T | Self:
+        if obj is None:
+            return self
+        raw_value = obj._clirm_data[self._index]
+        if raw_value is UNLOADED:
+            obj.load()
+            raw_value = obj._clirm_data[self._index]
+        return self._deserialize(raw_value)
+
+    def _generic_get(self, obj: Model | None, objtype: object = None) -> T | Self:
         if obj is None:
             return self
         raw_value = self.get_raw(obj)
         return self.deserialize(raw_value)
 
     def deserialize(self, raw_value: Any) -> T:
-        if self.allow_none and raw_value is None:
-            return None
-        return self.type_object(raw_value)
+        return self._deserialize(raw_value)
+
+    def _lazy_deserialize(self, raw_value: Any) -> T:
+        self.resolve_type()
+        return self._deserialize(raw_value)
 
     def get_raw(self, obj: Model) -> Any:
-        if self.name not in obj._clirm_data:
+        raw_value = obj._clirm_data[self._index]
+        if raw_value is UNLOADED:
             obj.load()
-        return obj._clirm_data[self.name]
+            raw_value = obj._clirm_data[self._index]
+        return raw_value
 
     def __set__(self, obj: Model, value: T) -> None:
         raw_value = self.serialize(value)
-        if self.name in obj._clirm_data and obj._clirm_data[self.name] == raw_value:
+        if obj._clirm_data[self._index] == raw_value:
             return
         self.set_raw(obj, raw_value)
 
     def serialize(self, value: T) -> Any:
-        if self.allow_none and value is None:
-            return None
-        if type(value) in (int, str):
-            return value
-        if not isinstance(value, self.type_object):
-            raise TypeError(
-                f"Cannot set value {value!r} in field of type {self.type_object}"
-            )
-        if issubclass(self.type_object, enum.Enum):
-            return value.value
-        if issubclass(self.type_object, Model):
-            return value.id
-        return value
+        return self._serialize(value)
+
+    def _lazy_serialize(self, value: T) -> Any:
+        self.resolve_type()
+        return self._serialize(value)
 
     def set_raw(self, obj: Model, value: Any) -> None:
         if self.full_type is Id:
             raise AttributeError("Cannot set id field")
-        obj._clirm_data[self.name] = value
-        obj._clirm_dirty_fields.add(self.name)
-        obj.save()
+        obj._clirm_data[self._index] = value
+        obj._clirm_dirty_fields.add(self._index)
+        if not obj._clirm_save_depth:
+            obj.save()
 
     @property
     def type_object(self) -> type[T]:
@@ -338,6 +711,8 @@ class Field(Generic[T]):
         if hasattr(self, "_type_object"):
             return
         self._full_type, self._type_object, self._allow_none = self.get_resolved_type()
+        self._serialize = make_serializer(self._type_object, self._allow_none)
+        self._deserialize = make_deserializer(self._type_object, self._allow_none)
         if issubclass(self._type_object, Model):
             if self.related_name is None:
                 self.related_name = self.model_cls.clirm_table_name + "_set"
@@ -355,14 +730,22 @@ class Field(Generic[T]):
             )
 
     def resolve_forward_ref(self, arg: ForwardRef) -> Any:
+        clirm = self.model_cls.clirm
+        key = (self.model_cls.__module__, arg.__forward_arg__)
+        try:
+            return clirm._forward_ref_cache[key]
+        except KeyError:
+            pass
         ns = {
-            **self.model_cls.clirm.get_name_to_model_cls(),
+            **clirm.get_name_to_model_cls(),
             **sys.modules[self.model_cls.__module__].__dict__,
         }
         try:
-            return eval(arg.__forward_code__, ns)
+            value = eval(arg.__forward_code__, ns)
         except (NameError, AttributeError) as e:
             raise UnresolvedType from e
+        clirm._forward_ref_cache[key] = value
+        return value
 
     def get_resolved_type(self) -> tuple[Any, type[object], bool]:
         param = self.get_type_parameter()
@@ -371,19 +754,17 @@ class Field(Generic[T]):
             arg = self.resolve_forward_ref(arg)
         if isinstance(arg, type):
             return (arg, arg, False)
-        if arg is Self or arg is typing_extensions.Self:
-            return (self.model_cls, self.model_cls, False)
-        if arg is Id:
-            return (arg, int, False)
-        origin = get_origin(arg)
-        if origin is Union or origin is UnionType:
-            args = get_args(arg)
-            if NoneType in args:
-                (arg,) = (obj for obj in args if obj is not NoneType)
-                if isinstance(arg, type):
-                    return (arg | None, arg, True)
-                elif arg is Self or arg is typing_extensions.Self:
-                    return (self.model_cls | None, self.model_cls, True)
+        try:
+            resolver = SPECIAL_TYPE_RESOLVERS.get(arg)
+        except TypeError:
+            # Unhashable, e.g. Annotated with a dict as metadata
+            resolver = None
+        if resolver is None:
+            resolver = ORIGIN_RESOLVERS.get(get_origin(arg))
+        if resolver is not None:
+            resolved = resolver(self, arg)
+            if resolved is not None:
+                return resolved
         return self.resolve_type_fallback(arg)
 
     def resolve_type_fallback(self, arg: Any) -> tuple[Any, type[object], bool]:
@@ -435,6 +816,95 @@ class Field(Generic[T]):
         return f"<Field: {self.name}>"
 
 
+def resolve_self(field: Field[Any], arg: Any) -> tuple[Any, type[object], bool]:
+    return (field.model_cls, field.model_cls, False)
+
+
+def resolve_id(field: Field[Any], arg: Any) -> tuple[Any, type[object], bool]:
+    return (arg, int, False)
+
+
+def resolve_union(field: Field[Any], arg: Any) -> tuple[Any, type[object], bool] | None:
+    args = get_args(arg)
+    if NoneType in args:
+        (arg,) = (obj for obj in args if obj is not NoneType)
+        if isinstance(arg, type):
+            return (arg | None, arg, True)
+        elif arg is Self or arg is typing_extensions.Self:
+            return (field.model_cls | None, field.model_cls, True)
+    return None
+
+
+TypeResolver = Callable[[Field[Any], Any], tuple[Any, type[object], bool] | None]
+SPECIAL_TYPE_RESOLVERS: dict[Any, TypeResolver] = {
+    Self: resolve_self,
+    typing_extensions.Self: resolve_self,
+    Id: resolve_id,
+}
+ORIGIN_RESOLVERS: dict[Any, TypeResolver] = {
+    Union: resolve_union,
+    UnionType: resolve_union,
+}
+
+
+def make_serializer(type_object: type[Any], allow_none: bool) -> Callable[[Any], Any]:
+    if issubclass(type_object, enum.Enum):
+        convert = operator.attrgetter("value")
+    elif issubclass(type_object, Model):
+        convert = operator.attrgetter("id")
+    else:
+        convert = None
+
+    def serialize(value: Any) -> Any:
+        if type(value) in (int, str):
+            return value
+        if not isinstance(value, type_object):
+            raise TypeError(
+                f"Cannot set value {value!r} in field of type {type_object}"
+            )
+        if convert is not None:
+            return convert(value)
+        return value
+
+    if allow_none:
+        return allow_none_wrapper(serialize)
+    return serialize
+
+
+def make_deserializer(type_object: type[Any], allow_none: bool) -> Callable[[Any], Any]:
+    if issubclass(type_object, enum.Enum):
+        deserialize = make_enum_deserializer(type_object)
+    else:
+        deserialize = type_object
+    if allow_none:
+        return allow_none_wrapper(deserialize)
+    return deserialize
+
+
+def make_enum_deserializer(enum_cls: type[enum.Enum]) -> Callable[[Any], Any]:
+    # Calling the enum class goes through EnumType.__call__, which is much
+    # slower than a dict lookup.
+    members = {member.value: member for member in enum_cls}
+
+    def deserialize(value: Any) -> Any:
+        try:
+            return members[value]
+        except KeyError:
+            # e.g. composite flags or values handled by _missing_()
+            return enum_cls(value)
+
+    return deserialize
+
+
+def allow_none_wrapper(func: Callable[[Any], Any]) -> Callable[[Any], Any]:
+    def wrapper(value: Any) -> Any:
+        if value is None:
+            return None
+        return func(value)
+
+    return wrapper
+
+
 def make_foreign_key_accessor(field: Field[Any]) -> Any:
     @property
     def accessor(self: Any) -> Query[field.model_cls]:
@@ -444,16 +914,40 @@ def make_foreign_key_accessor(field: Field[Any]) -> Any:
 
 
 class Model:
+    __slots__ = (
+        "_clirm_data",
+        "_clirm_dirty_fields",
+        "_clirm_save_depth",
+        "__weakref__",
+    )
+
     # Must be set in subclasses
     clirm: ClassVar[Clirm]
     clirm_table_name: ClassVar[str]
 
+    # May be set in subclasses: number of recently used objects that are kept
+    # alive in addition to the weak instance cache
+    clirm_cache_size: ClassVar[int] = 64
+
     # Set by the abstraction
     clirm_fields: ClassVar[dict[str, Field[Any]]]
     clirm_backrefs: list[Field[Any]]
     _clirm_instance_cache: ClassVar[weakref.WeakValueDictionary[int, Self]]
+    _clirm_hot_cache: ClassVar[list[Self | None]]
     _clirm_has_unresolved_types: ClassVar[bool] = True
-    _clirm_data: dict[str, Any]
+    # Column names in the order used for _clirm_data, starting with id
+    _clirm_columns: ClassVar[tuple[str, ...]]
+    _clirm_column_index: ClassVar[dict[str, int]]
+    # Attribute name -> field, in the same order
+    _clirm_column_fields: ClassVar[dict[str, Field[Any]]]
+    _clirm_select_columns: ClassVar[str]
+    _clirm_load_sql: ClassVar[str]
+    _clirm_delete_sql: ClassVar[str]
+    _clirm_create_plan: ClassVar[list[CreatePlanEntry] | None] = None
+    _clirm_row_type: ClassVar[RowType | None] = None
+    _clirm_data: list[Any]
+    _clirm_dirty_fields: set[int]
+    _clirm_save_depth: int
 
     DoesNotExist = DoesNotExist
 
@@ -463,7 +957,17 @@ class Model:
         if not hasattr(cls, "clirm_table_name"):
             return  # abstract class
 
+        # Used as a cache key for generated SQL
+        cls.clirm_table_name = sys.intern(cls.clirm_table_name)
         cls._clirm_instance_cache = weakref.WeakValueDictionary()
+        if cls.clirm_cache_size < 1:
+            raise ValueError("clirm_cache_size must be at least 1")
+        cls._clirm_hot_cache = [None] * cls.clirm_cache_size
+        cls._clirm_delete_sql = sys.intern(
+            f"DELETE FROM `{cls.clirm_table_name}` WHERE id = ?"
+        )
+        cls._clirm_create_plan = None
+        cls._clirm_row_type = None
         cls.clirm_fields = {}
         cls.clirm_backrefs = []
         for name, obj in cls.__dict__.items():
@@ -476,7 +980,35 @@ class Model:
                     )
                 obj.model_cls = cls
                 cls.clirm_fields[name] = obj
+        # Fields inherited from base classes (including id) come first
+        cls._clirm_column_fields = {
+            name: obj
+            for klass in reversed(cls.__mro__)
+            for name, obj in klass.__dict__.items()
+            if isinstance(obj, Field)
+        }
+        for name, obj in cls._clirm_column_fields.items():
+            if obj is not Model.id and name not in cls.__dict__:
+                # The position of an inherited field depends on the model, so
+                # each model gets its own copy. id is always first.
+                field = obj._clirm_copy()
+                setattr(cls, name, field)
+                cls._clirm_column_fields[name] = field
+        columns = list(cls._clirm_column_fields.values())
+        for index, field in enumerate(columns):
+            field._index = index
+        cls._clirm_columns = tuple(field.name for field in columns)
+        cls._clirm_column_index = {
+            name: index for index, name in enumerate(cls._clirm_columns)
+        }
+        cls._clirm_select_columns = ", ".join(field._quoted_name for field in columns)
+        cls._clirm_load_sql = sys.intern(
+            f"SELECT {cls._clirm_select_columns} FROM `{cls.clirm_table_name}`"
+            " WHERE id = ?"
+        )
         cls.clirm.models[cls.clirm_table_name] = cls
+        cls.clirm._name_to_model_cls = None
+        cls.clirm._forward_ref_cache.clear()
         cls.clirm.models_with_unresolved_types.add(cls)
         cls.clirm.try_resolve_all_types()
 
@@ -491,36 +1023,108 @@ class Model:
         return not has_unresolved_types
 
     def __init__(self, id: int, **kwargs: Any) -> None:
-        self._clirm_data = {"id": id, **kwargs}
-        self._clirm_dirty_fields = set()
+        # Everything is set up in __new__, which may return an existing object
+        # whose data must not be reset.
+        pass
 
     def __new__(cls, id: int, **kwargs: Any) -> Self:
-        if id in cls._clirm_instance_cache:
-            inst = cls._clirm_instance_cache[id]
-            inst._clirm_data.update(kwargs)
-        else:
+        inst = cls._clirm_get_cached(id)
+        if inst is None:
             inst = super().__new__(cls)
-            inst.__init__(id, **kwargs)
-            cls._clirm_instance_cache[id] = inst
+            inst._clirm_data = cls._clirm_empty_data(id)
+            inst._clirm_dirty_fields = set()
+            inst._clirm_save_depth = 0
+            cls._clirm_add_to_cache(id, inst)
+        for name, value in kwargs.items():
+            inst._clirm_data[cls._clirm_column_index[name]] = value
         return inst
 
+    @classmethod
+    def _clirm_empty_data(cls, id: int) -> list[Any]:
+        data = [UNLOADED] * len(cls._clirm_columns)
+        data[0] = id
+        return data
+
+    @classmethod
+    def _clirm_from_row(cls, row: Sequence[Any]) -> Self:
+        """Return the object for a row with the columns in _clirm_columns."""
+        id = row[0]
+        inst = cls._clirm_get_cached(id)
+        if inst is None:
+            inst = super().__new__(cls)
+            inst._clirm_data = list(row)
+            inst._clirm_dirty_fields = set()
+            inst._clirm_save_depth = 0
+            cls._clirm_add_to_cache(id, inst)
+        else:
+            inst._clirm_update_data(row)
+        return inst
+
+    @classmethod
+    def _clirm_get_cached(cls, id: int) -> Self | None:
+        # Recently used objects are kept alive in a small array of strong
+        # references, which is cheaper to check than the weak dictionary.
+        index = hash(id) % cls.clirm_cache_size
+        inst = cls._clirm_hot_cache[index]
+        if inst is not None and inst._clirm_data[0] == id:
+            return inst
+        inst = cls._clirm_instance_cache.get(id)
+        if inst is not None:
+            cls._clirm_hot_cache[index] = inst
+        return inst
+
+    @classmethod
+    def _clirm_add_to_cache(cls, id: int, inst: Self) -> None:
+        cls._clirm_instance_cache[id] = inst
+        cls._clirm_hot_cache[hash(id) % cls.clirm_cache_size] = inst
+
     def load(self) -> None:
-        query = f"SELECT * FROM `{self.clirm_table_name}` WHERE id = ?"
-        row = self.clirm.select_one(query, (self.id,))
+        row = self.clirm.select_tuple(self._clirm_load_sql, (self.id,))
         if row is None:
             raise DoesNotExist(self.id)
-        self._clirm_data.update(row)
+        # The columns are selected in storage order
+        self._clirm_update_data(row)
+
+    def _clirm_update_data(self, row: Sequence[Any]) -> None:
+        dirty = self._clirm_dirty_fields
+        if dirty and self._clirm_save_depth:
+            # Inside "with obj:", keep changes that will be saved on exit
+            data = self._clirm_data
+            for index, value in enumerate(row):
+                if index not in dirty:
+                    data[index] = value
+        else:
+            self._clirm_data[:] = row
+            dirty.clear()
 
     def save(self) -> None:
         if not self._clirm_dirty_fields:
             return
-        updates = ", ".join(
-            f"`{field_name}` = ?" for field_name in self._clirm_dirty_fields
-        )
-        params = [self._clirm_data[field] for field in self._clirm_dirty_fields]
-        query = f"UPDATE `{self.clirm_table_name}` SET {updates} WHERE id = ?"
-        self.clirm.execute(query, (*params, self.id))
-        self._clirm_dirty_fields.clear()
+        # Sort so that the same set of fields always produces the same SQL
+        indexes = sorted(self._clirm_dirty_fields)
+        column_names = tuple(self._clirm_columns[index] for index in indexes)
+        params = [self._clirm_data[index] for index in indexes]
+        query = make_update_sql(self.clirm_table_name, column_names)
+        try:
+            self.clirm.execute(query, (*params, self.id))
+        except BaseException:
+            # The values were not saved, so reload them from the database
+            # when they are next accessed.
+            for index in indexes:
+                self._clirm_data[index] = UNLOADED
+            raise
+        finally:
+            self._clirm_dirty_fields.clear()
+
+    def __enter__(self) -> Self:
+        # Within the block, field assignments are saved together on exit
+        self._clirm_save_depth += 1
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self._clirm_save_depth -= 1
+        if not self._clirm_save_depth:
+            self.save()
 
     def serialize(self) -> Self:
         self.load()
@@ -528,29 +1132,91 @@ class Model:
 
     @classmethod
     def create(cls, **kwargs: Any) -> Self:
+        column_names, params = cls._clirm_serialize_for_insert(kwargs)
+        query = make_insert_sql(cls.clirm_table_name, column_names)
+        cursor = cls.clirm.execute(query, params)
+        assert cursor.lastrowid is not None
+        return cls(cursor.lastrowid)
+
+    @classmethod
+    def create_many(cls, rows: Iterable[Mapping[str, Any]]) -> list[Self]:
+        # Rows with the same columns are inserted with a single executemany()
+        # call, and all rows are inserted in one transaction.
+        groups: dict[tuple[str, ...], list[tuple[int, tuple[object, ...]]]] = {}
+        num_rows = 0
+        for i, row in enumerate(rows):
+            column_names, params = cls._clirm_serialize_for_insert(dict(row))
+            groups.setdefault(column_names, []).append((i, params))
+            num_rows += 1
+        ids: list[int] = [0] * num_rows
+        with cls.clirm.transaction():
+            for column_names, group in groups.items():
+                query = make_insert_sql(cls.clirm_table_name, column_names)
+                cursor = cls.clirm.execute_many(query, [params for _, params in group])
+                # executemany() runs the INSERT once per row. Nothing else can
+                # write while the transaction is open, so the rows get
+                # consecutive rowids, unless a conflict clause (e.g.,
+                # ON CONFLICT IGNORE) skipped some of them.
+                if cursor.rowcount != len(group):
+                    raise sqlite3.IntegrityError(
+                        f"Only {cursor.rowcount} of {len(group)} rows were inserted"
+                        f" into {cls.clirm_table_name}"
+                    )
+                (last_id,) = cls.clirm.select_tuple("SELECT last_insert_rowid()")
+                first_id = last_id - len(group) + 1
+                for offset, (i, _) in enumerate(group):
+                    ids[i] = first_id + offset
+        return [cls(id) for id in ids]
+
+    @classmethod
+    def _clirm_make_create_plan(cls) -> list[CreatePlanEntry]:
+        plan = []
+        for name, field in cls.clirm_fields.items():
+            # Accessing allow_none also resolves the field's type
+            has_default = field.default is not None or field.allow_none
+            if type(field).serialize is Field.serialize:
+                serialize = field._serialize
+            else:
+                serialize = field.serialize
+            default = field.serialize(field.default) if has_default else None
+            plan.append((name, field.name, serialize, has_default, default))
+        return plan
+
+    @classmethod
+    def _clirm_get_row_type(cls) -> RowType:
+        """Return the named tuple type and deserializers for Query.iterator()."""
+        if cls._clirm_row_type is None:
+            # Tuple fields are named after the model's attributes, not its columns
+            row_type = collections.namedtuple(
+                f"{cls.__name__}Row", cls._clirm_column_fields, rename=True
+            )
+            # The id is stored as is
+            _, *fields = cls._clirm_column_fields.values()
+            deserializers = [identity, *[field.deserialize for field in fields]]
+            cls._clirm_row_type = (row_type, deserializers)
+        return cls._clirm_row_type
+
+    @classmethod
+    def _clirm_serialize_for_insert(
+        cls, kwargs: dict[str, Any]
+    ) -> tuple[tuple[str, ...], tuple[object, ...]]:
+        plan = cls._clirm_create_plan
+        if plan is None:
+            plan = cls._clirm_create_plan = cls._clirm_make_create_plan()
         column_names: list[str] = []
         params: list[object] = []
-        for name, field in cls.clirm_fields.items():
+        for name, column_name, serialize, has_default, default in plan:
             if name in kwargs:
-                cooked_value = kwargs.pop(name)
+                value = serialize(kwargs.pop(name))
+            elif has_default:
+                value = default
             else:
-                cooked_value = field.default
-                if cooked_value is None and not field.allow_none:
-                    continue
-            value = field.serialize(cooked_value)
-            column_names.append(field.name)
+                continue
+            column_names.append(column_name)
             params.append(value)
         if kwargs:
             raise TypeError(f"Extra kwargs {', '.join(kwargs)}")
-
-        placeholders = ",".join("?" for _ in column_names)
-        colnames_str = ",".join(f"`{name}`" for name in column_names)
-        query = (
-            f"INSERT INTO {cls.clirm_table_name}({colnames_str}) VALUES({placeholders})"
-        )
-        cursor = cls.clirm.execute(query, tuple(params))
-        assert cursor.lastrowid is not None
-        return cls(cursor.lastrowid)
+        return tuple(column_names), tuple(params)
 
     @classmethod
     def select(cls) -> Query[Self]:
@@ -565,5 +1231,29 @@ class Model:
         return cls.select().filter(*conditions, **kwargs).get()
 
     def delete_instance(self) -> None:
-        query = f"DELETE FROM {self.clirm_table_name} WHERE id = ?"
-        self.clirm.execute(query, (self.id,))
+        id = self.id
+        self.clirm.execute(self._clirm_delete_sql, (id,))
+        # SQLite may reuse the id, so make sure a new row with the same id
+        # does not get this object.
+        cls = type(self)
+        if self.clirm._transaction_thread is not None:
+            self.clirm._deleted_objects.append(self)
+        cls._clirm_instance_cache.pop(id, None)
+        index = hash(id) % cls.clirm_cache_size
+        if cls._clirm_hot_cache[index] is self:
+            cls._clirm_hot_cache[index] = None
+
+
+@functools.lru_cache(maxsize=512)
+def make_insert_sql(table_name: str, column_names: tuple[str, ...]) -> str:
+    placeholders = ",".join("?" for _ in column_names)
+    colnames_str = ",".join(f"`{name}`" for name in column_names)
+    return sys.intern(
+        f"INSERT INTO `{table_name}`({colnames_str}) VALUES({placeholders})"
+    )
+
+
+@functools.lru_cache(maxsize=512)
+def make_update_sql(table_name: str, column_names: tuple[str, ...]) -> str:
+    updates = ", ".join(f"`{name}` = ?" for name in column_names)
+    return sys.intern(f"UPDATE `{table_name}` SET {updates} WHERE id = ?")
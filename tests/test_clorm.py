@@ -1,14 +1,17 @@
 import enum
 import json
 import sqlite3
+import threading
 import typing
 from collections.abc import Sequence
 from dataclasses import dataclass
-from typing import Any, Self, TypeVar
+from pathlib import Path
+from typing import Annotated, Any, Self, TypeVar
 
 import pytest
 
 from clirm import Clirm, Field, Model
+from clirm.base import Condition
 
 
 class Status(enum.Enum):
@@ -70,6 +73,11 @@ def test() -> None:
     assert len(rows) == 2
     assert txn in rows
     assert txn4 in rows
+    assert txn in Taxon.select()
+    assert txn not in Taxon.select().filter(Taxon.id != txn.id)
+    assert txn4 in Taxon.select().order_by(Taxon.id.desc()).limit(1)
+    assert txn not in Taxon.select().order_by(Taxon.id.desc()).limit(1)
+    assert list(Taxon.select().order_by(Taxon.id).ids()) == [txn.id, txn4.id]
 
     txn.delete_instance()
     assert Taxon.select().count() == 1
@@ -77,7 +85,8 @@ def test() -> None:
     assert Taxon.select().count() == 0
 
     for i in range(5):
-        Taxon.create(name=f"Taxon{i}", extinct=i != 1)
+        new_txn = Taxon.create(name=f"Taxon{i}", extinct=i != 1)
+        assert new_txn.name == f"Taxon{i}"
 
     assert [t.name for t in Taxon.select()] == [f"Taxon{i}" for i in range(5)]
     assert [t.name for t in Taxon.select().limit(2)] == [f"Taxon{i}" for i in range(2)]
@@ -85,6 +94,19 @@ def test() -> None:
     assert [t.name for t in Taxon.select().order_by(Taxon.name.desc())] == [
         f"Taxon{4 - i}" for i in range(5)
     ]
+    assert list(
+        Taxon.select().filter(Taxon.extinct == False).only(Taxon.name, Taxon.extinct)
+    ) == [("Taxon1", False)]
+    assert list(Taxon.select().limit(2).only(Taxon.name, Taxon.status)) == [
+        ("Taxon0", None),
+        ("Taxon1", None),
+    ]
+    (row,) = Taxon.select().filter(Taxon.extinct == False).iterator()
+    assert row.name == "Taxon1"
+    assert row.extinct is False
+    assert row.id == Taxon.get(name="Taxon1").id
+    # The row type is created once per model
+    assert all(type(other) is type(row) for other in Taxon.select().iterator())
 
 
 def test_foreign_key() -> None:
@@ -163,6 +185,12 @@ def test_default() -> None:
     assert txn3.extinct is False
     assert txn3.status is Status.nomen_dubium
 
+    # columns with an explicit name are decoded and named after the attribute
+    _, row2, row3 = Taxon.select().iterator()
+    assert row2 == (txn2.id, "Megalomys", True, None)
+    assert row2.extinct is True
+    assert row3.status is Status.nomen_dubium
+
     with pytest.raises(sqlite3.IntegrityError):
         Taxon.create(extinct=True)  # name must be given
     with pytest.raises(TypeError):
@@ -272,3 +300,538 @@ def test_in_and_contains() -> None:
             Taxon.name.is_in(["Urotrichus", "Uropsilus", "Talpa"])
         )
     } == {"Urotrichus", "Uropsilus"}
+    assert {
+        txn.name
+        for txn in Taxon.select().filter(
+            Taxon.name.is_not_in(["Urotrichus", "Uropsilus", "Talpa"])
+        )
+    } == {"Neurotrichus"}
+    either = Taxon.name.startswith("Urop") | ~Taxon.name.contains("Uro")
+    assert either.stringify() == (
+        "((`name` LIKE ?) OR NOT INSTR(`name`, ?))",
+        ("Urop%", "Uro"),
+    )
+    assert (Taxon.name == None).stringify() == ("(`name` IS NULL)", ())
+    with pytest.raises(TypeError):
+        Taxon.select().filter(Taxon.name < None)
+    assert {txn.name for txn in Taxon.select().filter(either)} == {
+        "Uropsilus",
+        "Neurotrichus",
+    }
+    many_names = [f"Taxon{i}" for i in range(2000)]
+    assert Taxon.select().filter(Taxon.name.is_in(many_names)).count() == 0
+    assert Taxon.select().filter(Taxon.name.is_not_in(many_names)).count() == 3
+
+
+def test_create_many() -> None:
+    clirm_global = make_clirm(
+        ["CREATE TABLE taxon(id INTEGER PRIMARY KEY, name NOT NULL, status)"]
+    )
+
+    class Taxon(Model):
+        clirm = clirm_global
+        clirm_table_name = "taxon"
+
+        name = Field[str]()
+        status = Field[Status | None]()
+
+    existing = Taxon.create(name="Talpa")
+    txns = Taxon.create_many(
+        [
+            {"name": "Neurotrichus"},
+            {"name": "Uropsilus", "status": Status.nomen_dubium},
+            {"name": "Urotrichus"},
+        ]
+    )
+    assert [txn.name for txn in txns] == ["Neurotrichus", "Uropsilus", "Urotrichus"]
+    assert [txn.status for txn in txns] == [None, Status.nomen_dubium, None]
+    assert existing not in txns
+    assert Taxon.select().count() == 4
+    assert Taxon.create_many([]) == []
+
+    with pytest.raises(TypeError):
+        Taxon.create_many([{"name": "Talpa", "not_a_kwarg": 1}])
+
+
+def test_create_many_skipped_rows() -> None:
+    clirm_global = make_clirm(
+        ["CREATE TABLE taxon(id INTEGER PRIMARY KEY, name UNIQUE ON CONFLICT IGNORE)"]
+    )
+
+    class Taxon(Model):
+        clirm = clirm_global
+        clirm_table_name = "taxon"
+
+        name = Field[str]()
+
+    Taxon.create(name="Talpa")
+    with pytest.raises(sqlite3.IntegrityError):
+        Taxon.create_many([{"name": "Talpa"}, {"name": "Uropsilus"}])
+    # All rows are rolled back
+    assert [txn.name for txn in Taxon.select()] == ["Talpa"]
+
+
+def test_transaction() -> None:
+    clirm_global = make_clirm(
+        ["CREATE TABLE taxon(id INTEGER PRIMARY KEY, name NOT NULL, status)"]
+    )
+
+    class Taxon(Model):
+        clirm = clirm_global
+        clirm_table_name = "taxon"
+
+        name = Field[str]()
+        status = Field[Status | None]()
+
+    txn = Taxon.create(name="Neurotrichus")
+    with clirm_global.transaction():
+        txn.status = Status.valid
+        Taxon.create(name="Urotrichus")
+        assert clirm_global.conn.in_transaction
+    assert not clirm_global.conn.in_transaction
+    assert txn.status is Status.valid
+    assert Taxon.select().count() == 2
+
+    with pytest.raises(RuntimeError), clirm_global.transaction():
+        txn.status = Status.nomen_dubium
+        Taxon.create(name="Uropsilus")
+        raise RuntimeError
+    assert txn.status is Status.valid
+    assert Taxon.select().count() == 2
+
+    # Objects deleted in a rolled back transaction are still used for their row
+    with pytest.raises(RuntimeError), clirm_global.transaction():
+        txn.delete_instance()
+        raise RuntimeError
+    assert Taxon(txn.id) is txn
+    assert Taxon.get(name="Neurotrichus") is txn
+    assert txn.status is Status.valid
+
+
+def test_transaction_failed_commit() -> None:
+    clirm_global = make_clirm(
+        [
+            "CREATE TABLE taxon(id INTEGER PRIMARY KEY, name NOT NULL)",
+            "CREATE TABLE name(id INTEGER PRIMARY KEY, taxon REFERENCES taxon(id)"
+            " DEFERRABLE INITIALLY DEFERRED)",
+        ]
+    )
+    clirm_global.conn.execute("PRAGMA foreign_keys = ON")
+
+    class Taxon(Model):
+        clirm = clirm_global
+        clirm_table_name = "taxon"
+
+        name = Field[str]()
+
+    class Name(Model):
+        clirm = clirm_global
+        clirm_table_name = "name"
+
+        taxon = Field[Taxon]()
+
+    txn = Taxon.create(name="Neurotrichus")
+    # The foreign key is only checked on commit
+    with pytest.raises(sqlite3.IntegrityError), clirm_global.transaction():
+        txn.name = "Urotrichus"
+        Name.create(taxon=txn.id + 1)
+    assert not clirm_global.conn.in_transaction
+    assert txn.name == "Neurotrichus"
+    assert Name.select().count() == 0
+    Taxon.create(name="Uropsilus")
+    assert Taxon.select().count() == 2
+
+
+def test_connection_pragmas(tmp_path: Path) -> None:
+    assert make_clirm([]).journal_mode == "memory"
+
+    clirm_file = Clirm(sqlite3.connect(tmp_path / "test.db"))
+    assert clirm_file.journal_mode == "wal"
+    (synchronous,) = clirm_file.conn.execute("PRAGMA synchronous").fetchone()
+    assert synchronous == 1  # NORMAL
+
+    clirm_unconfigured = Clirm(
+        sqlite3.connect(tmp_path / "other.db"), configure_connection=False
+    )
+    assert clirm_unconfigured.journal_mode == "delete"
+    # The connection's row factory is left alone
+    assert clirm_unconfigured.conn.execute("SELECT 1").fetchone() == (1,)
+    assert clirm_unconfigured.select_one("SELECT 1 AS one")["one"] == 1
+
+    # Does not override the timeout passed to connect()
+    clirm_timeout = Clirm(sqlite3.connect(tmp_path / "timeout.db", timeout=60))
+    (busy_timeout,) = clirm_timeout.conn.execute("PRAGMA busy_timeout").fetchone()
+    assert busy_timeout == 60000
+
+    (cache_size,) = clirm_file.conn.execute("PRAGMA cache_size").fetchone()
+    assert cache_size == -20000
+    # Settings made by the caller are kept
+    conn = sqlite3.connect(tmp_path / "cache.db")
+    conn.execute("PRAGMA cache_size = -500")
+    Clirm(conn)
+    assert conn.execute("PRAGMA cache_size").fetchone() == (-500,)
+    assert conn.execute("PRAGMA temp_store").fetchone() == (2,)  # MEMORY
+
+    # Read-only connections cannot switch to WAL
+    uri = f"{(tmp_path / 'other.db').as_uri()}?mode=ro"
+    clirm_readonly = Clirm(sqlite3.connect(uri, uri=True))
+    assert clirm_readonly.journal_mode == "delete"
+
+
+def test_reader_pool(tmp_path: Path) -> None:
+    conn = sqlite3.connect(tmp_path / "test.db")
+    conn.execute("CREATE TABLE taxon(id INTEGER PRIMARY KEY, name NOT NULL)")
+    conn.commit()
+    clirm_global = Clirm(conn, reader_pool_size=1)
+
+    class Taxon(Model):
+        clirm = clirm_global
+        clirm_table_name = "taxon"
+
+        name = Field[str]()
+
+    Taxon.create_many([{"name": "Neurotrichus"}, {"name": "Urotrichus"}])
+    assert Taxon.select().count() == 2
+    for txn in Taxon.select():
+        # nested query while the only reader is in use
+        assert Taxon.select().filter(Taxon.id == txn.id).count() == 1
+        txn.name += "!"
+    assert {txn.name for txn in Taxon.select()} == {"Neurotrichus!", "Urotrichus!"}
+
+    with clirm_global.transaction():
+        Taxon.create(name="Uropsilus")
+        assert Taxon.select().count() == 3
+
+    with pytest.raises(ValueError):
+        Clirm(sqlite3.connect(":memory:"), reader_pool_size=1)
+
+
+def test_reader_pool_threads(tmp_path: Path) -> None:
+    conn = sqlite3.connect(tmp_path / "test.db")
+    conn.execute("CREATE TABLE taxon(id INTEGER PRIMARY KEY, name NOT NULL)")
+    conn.commit()
+    clirm_global = Clirm(conn, reader_pool_size=1)
+
+    class Taxon(Model):
+        clirm = clirm_global
+        clirm_table_name = "taxon"
+
+        name = Field[str]()
+
+    Taxon.create_many([{"name": "Neurotrichus"}, {"name": "Urotrichus"}])
+    holding = threading.Event()
+    release = threading.Event()
+    results: dict[str, object] = {}
+
+    def hold_reader() -> None:
+        for txn in Taxon.select():
+            # nested query on the reader this thread already holds
+            assert Taxon.select().filter(Taxon.id == txn.id).count() == 1
+            holding.set()
+            release.wait(timeout=10)
+        results["first"] = True
+
+    def wait_for_reader() -> None:
+        results["second"] = Taxon.select().count()
+
+    first = threading.Thread(target=hold_reader)
+    second = threading.Thread(target=wait_for_reader)
+    first.start()
+    assert holding.wait(timeout=10)
+    second.start()
+    # The only reader is in use, so the second thread waits for it
+    second.join(timeout=0.1)
+    assert second.is_alive()
+    release.set()
+    first.join(timeout=10)
+    second.join(timeout=10)
+    assert results == {"first": True, "second": 2}
+
+    def interleave() -> None:
+        outer = iter(Taxon.select())
+        next(outer)
+        inner = iter(Taxon.select())
+        next(inner)
+        # The inner query still uses the reader after the outer one finishes
+        assert len(list(outer)) == 1
+        second = threading.Thread(target=wait_for_reader)
+        second.start()
+        second.join(timeout=0.1)
+        assert second.is_alive()
+        assert len(list(inner)) == 1
+        second.join(timeout=10)
+        results["interleaved"] = True
+
+    interleaved = threading.Thread(target=interleave)
+    interleaved.start()
+    interleaved.join(timeout=10)
+    assert results["interleaved"]
+    assert clirm_global._readers is not None
+    assert clirm_global._readers.qsize() == 1
+
+    # A transaction on the main thread is not visible to other threads
+    with clirm_global.transaction():
+        Taxon.create(name="Uropsilus")
+        assert Taxon.select().count() == 3
+        other = threading.Thread(target=wait_for_reader)
+        other.start()
+        other.join(timeout=10)
+        assert results["second"] == 2
+
+    clirm_global.close_readers()
+    assert Taxon.select().count() == 3
+
+
+def test_save_on_exit() -> None:
+    clirm_global = make_clirm(
+        ["CREATE TABLE taxon(id INTEGER PRIMARY KEY, name NOT NULL, extinct, status)"]
+    )
+
+    class Taxon(Model):
+        clirm = clirm_global
+        clirm_table_name = "taxon"
+
+        name = Field[str]()
+        extinct = Field[bool]()
+        status = Field[Status | None]()
+
+    txn = Taxon.create(name="Neurotrichus", extinct=False)
+    statements: list[str] = []
+    clirm_global.conn.set_trace_callback(statements.append)
+    with txn:
+        txn.name = "Urotrichus"
+        txn.extinct = True
+        txn.status = Status.valid
+        assert txn.name == "Urotrichus"
+        assert statements == []
+        # unsaved changes survive reloading the row
+        assert [t.name for t in Taxon.select()] == ["Urotrichus"]
+    clirm_global.conn.set_trace_callback(None)
+    assert len([stmt for stmt in statements if stmt.startswith("UPDATE")]) == 1
+
+    txn.load()
+    assert txn.name == "Urotrichus"
+    assert txn.extinct is True
+    assert txn.status is Status.valid
+
+
+def test_cache_size() -> None:
+    clirm_global = make_clirm(["CREATE TABLE taxon(id INTEGER PRIMARY KEY, name)"])
+
+    class Taxon(Model):
+        clirm = clirm_global
+        clirm_table_name = "taxon"
+        clirm_cache_size = 1
+
+        name = Field[str]()
+
+    ids = [txn.id for txn in Taxon.create_many([{"name": "a"}, {"name": "b"}])]
+    assert len(Taxon._clirm_hot_cache) == 1
+    assert [Taxon(id).name for id in ids] == ["a", "b"]
+
+    with pytest.raises(ValueError):
+
+        class BadTaxon(Model):
+            clirm = clirm_global
+            clirm_table_name = "bad_taxon"
+            clirm_cache_size = 0
+
+
+def test_is_in_types() -> None:
+    clirm_global = make_clirm(
+        ["CREATE TABLE taxon(id INTEGER PRIMARY KEY, weight, data, status)"]
+    )
+
+    class Taxon(Model):
+        clirm = clirm_global
+        clirm_table_name = "taxon"
+
+        weight = Field[float]()
+        data = Field[bytes]()
+        status = Field[Status]()
+
+    Taxon.create(weight=1.5, data=b"a", status=Status.valid)
+    Taxon.create(weight=3.0, data=b"b", status=Status.nomen_dubium)
+
+    def count(cond: Any) -> int:
+        return Taxon.select().filter(cond).count()
+
+    assert count(Taxon.weight.is_in([1.5, 2.0])) == 1
+    assert count(Taxon.weight.is_in([3, float("nan")])) == 1
+    assert count(Taxon.data.is_in([b"a", b"b"])) == 2
+    assert count(Taxon.status.is_not_in([Status.valid])) == 1
+
+
+def test_is_in_affinity() -> None:
+    clirm_global = make_clirm(
+        ["CREATE TABLE taxon(id INTEGER PRIMARY KEY, name TEXT, status TEXT)"]
+    )
+
+    class Taxon(Model):
+        clirm = clirm_global
+        clirm_table_name = "taxon"
+
+        name = Field[str]()
+        status = Field[Status]()
+
+    # TEXT affinity stores these as '1'
+    Taxon.create(name=1, status=Status.valid)
+
+    def count(cond: Any) -> int:
+        return Taxon.select().filter(cond).count()
+
+    assert count(Taxon.status == Status.valid) == 1
+    assert count(Taxon.status.is_in([Status.valid])) == 1
+    assert count(Taxon.status.is_not_in([Status.valid])) == 0
+    assert count(Taxon.name.is_in([1])) == 1
+    assert count(Taxon.name.is_not_in([1])) == 0
+    # Long lists use one parameter per value if the connection allows it
+    assert count(Taxon.name.is_in(range(1500))) == 1
+    # Beyond the limit, they are passed as JSON, which compares without affinity
+    clirm_global.conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 100)
+    assert count(Taxon.name.is_in(range(50))) == 1
+    assert count(Taxon.name.is_in(range(200))) == 0
+    assert count(Taxon.name.is_in([str(i) for i in range(200)])) == 1
+
+
+class Permission(enum.Flag):
+    read = 1
+    write = 2
+
+
+def test_flag_enum() -> None:
+    clirm_global = make_clirm(["CREATE TABLE user(id INTEGER PRIMARY KEY, permission)"])
+
+    class User(Model):
+        clirm = clirm_global
+        clirm_table_name = "user"
+
+        permission = Field[Permission]()
+
+    user = User.create(permission=Permission.read | Permission.write)
+    assert user.permission == Permission.read | Permission.write
+    user.permission = Permission.write
+    assert user.permission is Permission.write
+
+
+def test_abstract_base() -> None:
+    clirm_global = make_clirm(
+        [
+            "CREATE TABLE taxon(id INTEGER PRIMARY KEY, name, extinct)",
+            "CREATE TABLE genus(id INTEGER PRIMARY KEY, name, gender, extinct)",
+        ]
+    )
+
+    class Base(Model):
+        clirm = clirm_global
+
+        name = Field[str]()
+
+    class Taxon(Base):
+        clirm_table_name = "taxon"
+
+        extinct = Field[bool]()
+
+    class Genus(Base):
+        clirm_table_name = "genus"
+
+        gender = Field[str]()
+
+    clirm_global.conn.execute(
+        "INSERT INTO taxon(name, extinct) VALUES('Neurotrichus', 0)"
+    )
+    clirm_global.conn.execute("INSERT INTO genus(name, gender) VALUES('Talpa', 'f')")
+    clirm_global.conn.commit()
+
+    (txn,) = Taxon.select()
+    assert txn.name == "Neurotrichus"
+    assert txn.extinct is False
+    txn.name = "Urotrichus"
+    assert Taxon(txn.id).name == "Urotrichus"
+    (genus,) = Genus.select()
+    assert genus.name == "Talpa"
+    assert genus.gender == "f"
+
+    # The same field may be at different positions in different models
+    class Dated(Model):
+        clirm = clirm_global
+
+        extinct = Field[bool | None]()
+
+    class Species(Base, Dated):
+        clirm_table_name = "taxon"
+
+    class Subgenus(Dated):
+        clirm_table_name = "genus"
+
+        gender = Field[str]()
+
+    species = Species(txn.id)
+    assert species.name == "Urotrichus"
+    assert species.extinct is False
+    subgenus = Subgenus(genus.id)
+    assert subgenus.extinct is None
+    assert subgenus.gender == "f"
+    species.extinct = True
+    assert Taxon(txn.id).extinct is False
+    Taxon(txn.id).load()
+    assert Taxon(txn.id).extinct is True
+
+
+def test_failed_save() -> None:
+    clirm_global = make_clirm(
+        ["CREATE TABLE taxon(id INTEGER PRIMARY KEY, name UNIQUE, extinct)"]
+    )
+
+    class Taxon(Model):
+        clirm = clirm_global
+        clirm_table_name = "taxon"
+
+        name = Field[str]()
+        extinct = Field[bool]()
+
+    Taxon.create(name="a", extinct=False)
+    txn = Taxon.create(name="b", extinct=False)
+    with pytest.raises(sqlite3.IntegrityError):
+        txn.name = "a"
+    assert txn.name == "b"
+    txn.extinct = True
+    txn.load()
+    assert txn.name == "b"
+    assert txn.extinct is True
+
+    with pytest.raises(sqlite3.IntegrityError), txn:
+        txn.name = "a"
+        txn.extinct = False
+    assert txn.name == "b"
+    assert txn.extinct is True
+
+
+AnnotatedT = TypeVar("AnnotatedT")
+
+
+def test_resolve_type_fallback() -> None:
+    clirm_global = make_clirm(["CREATE TABLE taxon(id INTEGER PRIMARY KEY, length)"])
+
+    class AnnotatedField(Field[AnnotatedT]):
+        def resolve_type_fallback(self, arg: Any) -> tuple[Any, type[object], bool]:
+            origin, *_ = typing.get_args(arg)
+            return (arg, origin, False)
+
+    class Taxon(Model):
+        clirm = clirm_global
+        clirm_table_name = "taxon"
+
+        length = AnnotatedField[Annotated[int, {"unit": "mm"}]]()
+
+    txn = Taxon.create(length=3)
+    assert Taxon(txn.id).length == 3
+    assert Taxon.length.type_object is int
+
+
+def test_condition_without_sql() -> None:
+    class Incomplete(Condition):
+        __slots__ = ()
+
+    with pytest.raises(NotImplementedError):
+        Incomplete().stringify()